@@ -1,81 +1,191 @@
 """
 聊天截图 OCR Web 应用
 ====================
-Flask + SSE 实现实时进度更新
+Quart (ASGI) + SSE 实现实时进度更新
 """
 
 import os
 import json
-import queue
+import atexit
+import asyncio
 import threading
-from flask import Flask, render_template, request, Response, send_file, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from quart import Quart, render_template, request, Response, jsonify
 from werkzeug.utils import secure_filename
-from io import BytesIO
 
-from ocr_core import process_ocr_workflow, get_today_beijing
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-app = Flask(__name__)
+from ocr_core import process_ocr_workflow, get_today_beijing, shrink_image, spool_image
+
+# 启动时读取配置
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+PORT = int(os.environ.get('PORT', 5000))
+if not GEMINI_API_KEY:
+    print("ℹ️ 未配置 GEMINI_API_KEY，用户需在页面输入自己的 API Key")
+
+app = Quart(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max
+app.config['BODY_TIMEOUT'] = 300  # 慢速网络上传 100MB 需要更长时间（Quart 默认 60 秒）
+
+# 已结束任务的数据最多保留 64 个、15 分钟，避免客户端未下载时内存/磁盘泄漏
+TASK_CACHE_SIZE = 64
+TASK_CACHE_TTL = 15 * 60
+
+
+def sse_frame(data) -> bytes:
+    """编码一条 SSE 消息"""
+    if orjson is not None:
+        payload = orjson.dumps(data)
+    else:
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    return b"data: " + payload + b"\n\n"
+
 
-# 存储每个任务的进度队列
-progress_queues = {}
+PING_FRAME = sse_frame({'type': 'ping'})
+
+
+class ProgressChannel:
+    """
+    进度消息通道：后台线程通过事件循环线程安全地写入 asyncio.Queue
+
+    消息在生产者一侧编码为 SSE 帧，队列中存放 (frame, 是否为结束消息)。
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, msg):
+        item = (sse_frame(msg), msg.get('type') in ('complete', 'error'))
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:
+            # 事件循环已关闭（服务退出中）
+            pass
+
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class _ResultCache(TTLCache):
+    """ZIP 路径缓存，淘汰时删除临时文件"""
+
+    def popitem(self):
+        key, zip_path = super().popitem()
+        _remove_file(zip_path)
+        return key, zip_path
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for _, zip_path in expired:
+            _remove_file(zip_path)
+        return expired
+
+
+# 后台 OCR 任务线程池，限制同时处理的任务数
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', 4))
+_WORKER_POOL = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix='ocr')
+_worker_slots = threading.BoundedSemaphore(OCR_WORKERS)
+atexit.register(_WORKER_POOL.shutdown, wait=True)
+
+# cachetools 不是线程安全的，访问需加锁
+# 运行中的任务不受 TTL 限制（数量受 OCR_WORKERS 约束），结束后才移入 _queues 开始计时
+_tasks_lock = threading.RLock()
+_running = {}  # {task_id: ProgressChannel}
+_queues = TTLCache(maxsize=TASK_CACHE_SIZE, ttl=TASK_CACHE_TTL)      # {task_id: ProgressChannel}
+_results = _ResultCache(maxsize=TASK_CACHE_SIZE, ttl=TASK_CACHE_TTL)  # {task_id: zip_path}
 
 
 @app.route('/')
-def index():
+async def index():
     """主页"""
     today = get_today_beijing()
-    return render_template('index.html', today=today)
+    return await render_template('index.html', today=today)
+
+
+def _load_images(files):
+    """读取图片到临时文件，并为过大的图片生成 OCR 用的缩小副本（ZIP 中保留原图）"""
+    images = []
+    try:
+        for f in files:
+            filename = secure_filename(f.filename) or 'image.png'
+            img_file = spool_image(f.stream)
+            images.append((filename, img_file, shrink_image(filename, img_file)))
+    except Exception:
+        _close_images(images)
+        raise
+    return images
+
+
+def _close_images(images):
+    for _, img_file, ocr_file in images:
+        img_file.close()
+        ocr_file.close()
 
 
 @app.route('/api/process', methods=['POST'])
-def process():
+async def process():
     """处理 OCR 请求"""
     try:
         # 获取表单数据
-        city = request.form.get('city', '城市')
-        house_type = request.form.get('house_type', '二手房')
-        community = request.form.get('community', '小区')
-        recipient = request.form.get('recipient', '经纪人')
-        screenshot_date = request.form.get('screenshot_date', get_today_beijing())
+        form = await request.form
+        city = form.get('city', '城市')
+        house_type = form.get('house_type', '二手房')
+        community = form.get('community', '小区')
+        recipient = form.get('recipient', '经纪人')
+        screenshot_date = form.get('screenshot_date', get_today_beijing())
         
         # 获取上传的图片
-        files = request.files.getlist('images')
+        files = (await request.files).getlist('images')
         if not files:
             return jsonify({'error': '请上传图片'}), 400
         
         if len(files) > 30:
             return jsonify({'error': '最多支持30张图片'}), 400
         
-        # 读取图片
-        images = []
-        for f in files:
-            filename = secure_filename(f.filename) or 'image.png'
-            img_bytes = f.read()
-            images.append((filename, img_bytes))
+        # 获取 API Key（优先使用用户提供的，否则使用服务器配置的）
+        api_key = form.get('api_key') or GEMINI_API_KEY
+        if not api_key:
+            return jsonify({'error': '请输入您的 Gemini API Key'}), 400
+        
+        # 所有线程都忙时直接拒绝，不在队列中无限堆积，也不做任何图片处理
+        if not _worker_slots.acquire(blocking=False):
+            response = jsonify({'error': '服务器繁忙，请稍后重试'})
+            response.headers['Retry-After'] = '30'
+            return response, 503
+        
+        # 解码/缩小图片较耗 CPU，放到线程中避免阻塞事件循环
+        try:
+            images = await asyncio.to_thread(_load_images, files)
+        except Exception:
+            _worker_slots.release()
+            raise
         
         # 生成任务 ID
         task_id = os.urandom(8).hex()
-        progress_queues[task_id] = queue.Queue()
+        q = ProgressChannel(asyncio.get_running_loop())
         
         # 进度回调
         def progress_callback(msg, current, total):
-            progress_queues[task_id].put({
+            q.put({
                 'type': 'progress',
                 'message': msg,
                 'current': current,
                 'total': total
             })
         
-        # 获取 API Key（优先使用用户提供的，否则使用服务器配置的）
-        api_key = request.form.get('api_key') or os.environ.get('GEMINI_API_KEY')
-        if not api_key:
-            return jsonify({'error': '请输入您的 Gemini API Key'}), 400
-        
         # 在后台线程处理
         def process_task():
             try:
-                zip_bytes = process_ocr_workflow(
+                zip_path = process_ocr_workflow(
                     images=images,
                     city=city,
                     house_type=house_type,
@@ -86,23 +196,38 @@ def process():
                     progress_callback=progress_callback
                 )
                 
+                # 存储 ZIP 路径供下载（需在发送完成信号之前）
+                with _tasks_lock:
+                    _results[task_id] = zip_path
+                
                 # 发送完成信号和下载链接
-                progress_queues[task_id].put({
+                q.put({
                     'type': 'complete',
                     'download_id': task_id
                 })
                 
-                # 存储 ZIP 数据供下载
-                app.config[f'zip_{task_id}'] = zip_bytes
-                
             except Exception as e:
-                progress_queues[task_id].put({
+                q.put({
                     'type': 'error',
                     'message': str(e)
                 })
+            finally:
+                _close_images(images)
+                with _tasks_lock:
+                    _queues[task_id] = _running.pop(task_id)
+                _worker_slots.release()
         
-        thread = threading.Thread(target=process_task)
-        thread.start()
+        # 登记任务并提交；提交失败（如服务正在退出）时归还资源
+        try:
+            with _tasks_lock:
+                _running[task_id] = q
+            _WORKER_POOL.submit(process_task)
+        except Exception:
+            with _tasks_lock:
+                _running.pop(task_id, None)
+            _close_images(images)
+            _worker_slots.release()
+            raise
         
         return jsonify({'task_id': task_id})
         
@@ -111,29 +236,31 @@ def process():
 
 
 @app.route('/api/progress/<task_id>')
-def progress(task_id):
+async def progress(task_id):
     """SSE 进度流"""
-    def generate():
-        q = progress_queues.get(task_id)
+    async def generate():
+        with _tasks_lock:
+            q = _running.get(task_id) or _queues.get(task_id)
         if not q:
-            yield f"data: {json.dumps({'type': 'error', 'message': '任务不存在'})}\n\n"
+            yield sse_frame({'type': 'error', 'message': '任务不存在'})
             return
         
         while True:
             try:
-                data = q.get(timeout=30)
-                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+                frame, final = await asyncio.wait_for(q.queue.get(), timeout=30)
+                yield frame
                 
-                if data.get('type') in ('complete', 'error'):
+                if final:
                     break
-            except queue.Empty:
+            except asyncio.TimeoutError:
                 # 发送心跳保持连接
-                yield f"data: {json.dumps({'type': 'ping'})}\n\n"
+                yield PING_FRAME
             except Exception as e:
-                yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+                yield sse_frame({'type': 'error', 'message': str(e)})
                 break
     
     response = Response(generate(), mimetype='text/event-stream')
+    response.timeout = None  # SSE 连接可能持续数分钟，取消 Quart 默认的响应超时
     response.headers['Cache-Control'] = 'no-cache'
     response.headers['X-Accel-Buffering'] = 'no'  # 禁用 nginx 缓冲
     response.headers['Connection'] = 'keep-alive'
@@ -141,25 +268,36 @@ def progress(task_id):
 
 
 @app.route('/api/download/<download_id>')
-def download(download_id):
+async def download(download_id):
     """下载 ZIP 文件"""
-    zip_bytes = app.config.get(f'zip_{download_id}')
-    if not zip_bytes:
+    with _tasks_lock:
+        zip_path = _results.pop(download_id, None)
+        # 清理数据
+        _queues.pop(download_id, None)
+    if not zip_path:
+        return jsonify({'error': '下载链接已过期'}), 404
+    try:
+        f = open(zip_path, 'rb')
+    except OSError:
         return jsonify({'error': '下载链接已过期'}), 404
     
-    # 清理数据
-    del app.config[f'zip_{download_id}']
-    if download_id in progress_queues:
-        del progress_queues[download_id]
+    # 打开后立即删除路径：数据由文件句柄持有，即使响应体从未被读取（HEAD 请求、
+    # 客户端提前断开），句柄关闭时空间也会释放，不会遗留临时文件
+    _remove_file(zip_path)
+    size = os.fstat(f.fileno()).st_size
     
-    return send_file(
-        BytesIO(zip_bytes),
-        mimetype='application/zip',
-        as_attachment=True,
-        download_name=f'chat_ocr_result.zip'
-    )
+    # 分块发送
+    async def stream_zip(f):
+        with f:
+            while chunk := await asyncio.to_thread(f.read, 256 * 1024):
+                yield chunk
+    
+    response = Response(stream_zip(f), mimetype='application/zip')
+    response.timeout = None
+    response.headers['Content-Disposition'] = 'attachment; filename=chat_ocr_result.zip'
+    response.headers['Content-Length'] = str(size)
+    return response
 
 
 if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
+    app.run(host='0.0.0.0', port=PORT, debug=True)
@@ -8,16 +8,25 @@ from datetime import datetime
 from pathlib import Path
 import re
 import os
+import base64
+import hashlib
+import json
+import time
+import threading
 import shutil
 import tempfile
 import zipfile
+import multiprocessing
 from collections import defaultdict
-from typing import Callable, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import BinaryIO, Callable, Optional
 from io import BytesIO
 
+import numpy as np
 from PIL import Image
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 
 try:
     import pytz
@@ -25,40 +34,89 @@ try:
 except ImportError:
     BEIJING_TZ = None
 
+# 本地 OCR 进程池大小（绕开 GIL，默认不启用）；小于 2 时在当前进程内识别。
+# 每个进程各加载一份 ONNX 模型，小内存实例（如 Render Free）请保持默认。
+LOCAL_OCR_PROCESSES = int(os.environ.get('LOCAL_OCR_PROCESSES', 0))
+USE_OCR_PROCESS_POOL = False
+_PROC_POOL = None
+_PROC_POOL_LOCK = threading.Lock()
+# 进程池的工作进程通过此环境变量识别自己（由创建进程池的进程设置，spawn 时继承）
+_POOL_WORKER_ENV = "CHAT_OCR_POOL_WORKER"
+_IS_POOL_WORKER = os.environ.get(_POOL_WORKER_ENV) == "1"
+
 # 本地 OCR（可通过环境变量禁用，用于云端部署）
 LOCAL_OCR = None
 if os.environ.get('DISABLE_LOCAL_OCR', '').lower() not in ('1', 'true', 'yes'):
     try:
         from rapidocr_onnxruntime import RapidOCR
-        LOCAL_OCR = RapidOCR()
-        print("✅ 本地 OCR 已启用 (RapidOCR)")
+        # 守护进程（如 hypercorn 默认的 worker）不能创建子进程，只能在进程内识别
+        daemonic = multiprocessing.current_process().daemon
+        if LOCAL_OCR_PROCESSES >= 2 and daemonic:
+            print("⚠️ 当前为守护进程，无法使用 OCR 进程池，改为进程内识别")
+        if LOCAL_OCR_PROCESSES >= 2 and not daemonic:
+            # 模型由工作进程在 _init_worker 中加载，主进程不再持有一份
+            USE_OCR_PROCESS_POOL = True
+            if not _IS_POOL_WORKER:
+                print(f"✅ 本地 OCR 已启用 (RapidOCR, {LOCAL_OCR_PROCESSES} 个进程)")
+        else:
+            LOCAL_OCR = RapidOCR()
+            print("✅ 本地 OCR 已启用 (RapidOCR)")
     except Exception as e:
         print(f"⚠️ 本地 OCR 加载失败: {e}")
         LOCAL_OCR = None
 else:
     print("ℹ️ 本地 OCR 已禁用 (DISABLE_LOCAL_OCR=true)")
 
+# 聊天内容分析使用的模型
+OCR_MODEL = "gemini-3-flash-preview"
+
+# Batch 模式（半价、服务端并行），超时后回退到同步调用
+USE_GEMINI_BATCH = os.environ.get('GEMINI_BATCH', '').lower() in ('1', 'true', 'yes')
+GEMINI_BATCH_TIMEOUT = int(os.environ.get('GEMINI_BATCH_TIMEOUT', 300))
+
+# 同步分析的服务层级："flex"（半价，延迟较高）或 "standard"
+GEMINI_SERVICE_TIER = os.environ.get('GEMINI_SERVICE_TIER', 'flex').lower()
+
+# 同步模式下并发分析的对话数（免费额度可调低以避免限流）
+GEMINI_PARALLEL = max(1, int(os.environ.get('GEMINI_PARALLEL', 4)))
+
+# 上传图片在内存中缓存的上限，超过后写入临时文件
+SPOOL_MAX_SIZE = 4 * 1024 * 1024
+
+# Gemini 客户端缓存（按 API Key），复用连接池
+_CLIENT_CACHE: dict[str, genai.Client] = {}
+_CLIENT_CACHE_MAX = 32
+_CLIENT_LOCK = threading.Lock()
+
 
 # =============================================================================
 # 工具函数
 # =============================================================================
 
+_SANITIZE_RE = re.compile(r'[\\/:*?"<>|]')
+_TIME_RE = re.compile(r"\d{1,2}:\d{2}")
+
+
 def sanitize(text: str, fallback: str) -> str:
     """清理文件名中的非法字符"""
-    cleaned = re.sub(r'[\\/:*?"<>|]', "_", text.strip())
+    cleaned = _SANITIZE_RE.sub("_", text.strip())
     cleaned = cleaned.replace(" ", "")
     return cleaned or fallback
 
 
 def is_time_like(text: str) -> bool:
-    return bool(re.fullmatch(r"\d{1,2}:\d{2}", text))
+    return bool(_TIME_RE.fullmatch(text))
 
 
 def mostly_digits(text: str) -> bool:
     if not text:
         return False
-    digits = sum(ch.isdigit() for ch in text)
-    chinese = sum("\u4e00" <= ch <= "\u9fff" for ch in text)
+    digits = chinese = 0
+    for ch in text:
+        if ch.isdigit():
+            digits += 1
+        elif "\u4e00" <= ch <= "\u9fff":
+            chinese += 1
     return digits >= max(3, int(len(text) * 0.7)) or digits >= chinese * 2
 
 
@@ -67,20 +125,98 @@ def pick_top_name(results) -> str:
     if not results:
         return "对方姓名"
 
-    candidates = []
+    # 单次遍历，同时记录最顶部的可用文本和最顶部的任意文本（兜底）
+    best_y = fallback_y = None
+    best_text = fallback_text = ""
     for item in results:
         box, text = item[0], str(item[1]).strip()
+        top_y = min(point[1] for point in box)
+        if fallback_y is None or top_y < fallback_y:
+            fallback_y, fallback_text = top_y, text
         if not text or is_time_like(text) or mostly_digits(text):
             continue
-        top_y = min(point[1] for point in box)
-        candidates.append((top_y, text))
+        if best_y is None or top_y < best_y:
+            best_y, best_text = top_y, text
+
+    if best_y is None:
+        return fallback_text or "对方姓名"
+    return best_text
 
-    if not candidates:
-        top_item = min(results, key=lambda item: min(point[1] for point in item[0]))
-        return str(top_item[1]).strip() or "对方姓名"
 
-    candidates.sort(key=lambda t: t[0])
-    return candidates[0][1]
+# Gemini 可以直接接收的图片格式，其余格式需重新编码为 PNG
+_GEMINI_IMAGE_FORMATS = {"PNG", "JPEG", "WEBP"}
+
+
+def gemini_image(filename: str, img_bytes: bytes) -> Optional[tuple[bytes, str]]:
+    """
+    准备发送给 Gemini 的图片，返回 (bytes, mime_type)
+
+    根据文件头判断格式（不解码像素）：PNG/JPEG/WEBP 原样发送，
+    其他可解码的格式转为 PNG，无法解码时返回 None。
+    """
+    try:
+        img = Image.open(BytesIO(img_bytes))
+        if img.format in _GEMINI_IMAGE_FORMATS:
+            return img_bytes, Image.MIME[img.format]
+        if img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            img = img.convert("RGB")
+        out = BytesIO()
+        img.save(out, format="PNG")
+        return out.getvalue(), "image/png"
+    except Exception as e:
+        print(f"警告: 无法加载图片 {filename}: {e}")
+        return None
+
+
+def read_image(img_file: BinaryIO) -> bytes:
+    """读取图片文件对象的全部内容（从头开始）"""
+    img_file.seek(0)
+    return img_file.read()
+
+
+def spool_image(stream: BinaryIO) -> BinaryIO:
+    """把上传流复制到 SpooledTemporaryFile，超过阈值自动落盘"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    shutil.copyfileobj(stream, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def shrink_image(filename: str, img_file: BinaryIO, max_side: int = 1600) -> BinaryIO:
+    """
+    生成用于 OCR 的缩小副本（长边不超过 max_side），减少上传带宽和 Gemini token
+
+    原图不会被修改或关闭；已经足够小或无法解码的图片直接返回原文件对象。
+    """
+    try:
+        img_file.seek(0)
+        img = Image.open(img_file)
+        if max(img.size) <= max_side:
+            return img_file
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        img.convert("RGB").save(out, format="JPEG", quality=85)
+    except Exception as e:
+        print(f"警告: 无法缩小图片 {filename}: {e}")
+        return img_file
+    out.seek(0)
+    return out
+
+
+def _get_client(api_key: str) -> genai.Client:
+    """获取（或创建）该 API Key 对应的 Gemini 客户端"""
+    client = _CLIENT_CACHE.get(api_key)
+    if client is not None:
+        return client
+    with _CLIENT_LOCK:
+        client = _CLIENT_CACHE.get(api_key)
+        if client is None:
+            client = genai.Client(api_key=api_key)
+            if len(_CLIENT_CACHE) >= _CLIENT_CACHE_MAX:
+                # 淘汰最早创建的客户端
+                _CLIENT_CACHE.pop(next(iter(_CLIENT_CACHE)))
+            _CLIENT_CACHE[api_key] = client
+        return client
 
 
 def get_today_beijing() -> str:
@@ -103,8 +239,12 @@ def get_today_full() -> str:
 
 def detect_name_with_gemini(img_bytes: bytes, client) -> str:
     """使用 Gemini 识别聊天截图中的对方姓名（仅返回姓名，用最快的模型）"""
+    prepared = gemini_image("截图", img_bytes)
+    if prepared is None:
+        return "对方"
     try:
-        img = Image.open(BytesIO(img_bytes))
+        data, mime_type = prepared
+        img = types.Part.from_bytes(data=data, mime_type=mime_type)
         response = client.models.generate_content(
             model="gemini-2.5-flash",  # 保持准确性
             contents=[
@@ -121,28 +261,93 @@ def detect_name_with_gemini(img_bytes: bytes, client) -> str:
         return "对方"
 
 
+def _init_worker():
+    """进程池初始化：每个工作进程只加载一次 RapidOCR"""
+    global LOCAL_OCR
+    if LOCAL_OCR is None:
+        from rapidocr_onnxruntime import RapidOCR
+        LOCAL_OCR = RapidOCR()
+
+
+def _get_proc_pool() -> ProcessPoolExecutor:
+    """按需创建本地 OCR 进程池（仅在 USE_OCR_PROCESS_POOL 时使用）"""
+    global _PROC_POOL
+    with _PROC_POOL_LOCK:
+        if _PROC_POOL is None:
+            os.environ[_POOL_WORKER_ENV] = "1"
+            # 使用 spawn，避免在多线程进程中 fork
+            _PROC_POOL = ProcessPoolExecutor(
+                max_workers=LOCAL_OCR_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker
+            )
+        return _PROC_POOL
+
+
+def _detect_name_in_pool(img_bytes: bytes) -> str:
+    """在进程池中识别姓名；工作进程崩溃时丢弃进程池，下次调用重新创建"""
+    global _PROC_POOL
+    pool = _get_proc_pool()
+    try:
+        return pool.submit(_detect_name_local, img_bytes).result()
+    except BrokenProcessPool:
+        with _PROC_POOL_LOCK:
+            if _PROC_POOL is pool:
+                _PROC_POOL = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+
+def _disable_proc_pool(reason: Exception) -> None:
+    """进程池无法创建子进程等情况下，永久改为在当前进程内加载 RapidOCR"""
+    global USE_OCR_PROCESS_POOL, LOCAL_OCR, _PROC_POOL
+    with _PROC_POOL_LOCK:
+        if not USE_OCR_PROCESS_POOL:
+            return
+        print(f"⚠️ OCR 进程池不可用，改为进程内识别: {reason!r}")
+        pool, _PROC_POOL = _PROC_POOL, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        try:
+            from rapidocr_onnxruntime import RapidOCR
+            LOCAL_OCR = RapidOCR()
+        except Exception as e:
+            print(f"⚠️ 本地 OCR 加载失败: {e}")
+        USE_OCR_PROCESS_POOL = False
+
+
+def _detect_name_local(img_bytes: bytes) -> str:
+    """使用本地 OCR 识别姓名，失败返回空字符串（可在工作进程中运行）"""
+    try:
+        # 直接在内存中解码，RapidOCR 使用 OpenCV 的 BGR 通道顺序
+        img = Image.open(BytesIO(img_bytes)).convert("RGB")
+        arr = np.ascontiguousarray(np.asarray(img)[:, :, ::-1])
+        
+        results, _ = LOCAL_OCR(arr)
+        return sanitize(pick_top_name(results), "")
+    except Exception as e:
+        print(f"本地 OCR 失败: {e}")
+        return ""
+
+
 def detect_name_from_image(img_bytes: bytes, gemini_client=None) -> str:
     """从图片中检测对方姓名（优先本地 OCR，失败则用 Gemini）"""
-    # 尝试本地 OCR
-    if LOCAL_OCR is not None:
-        temp_path = None
+    # 尝试本地 OCR（有进程池时交给工作进程，只传输图片 bytes 和姓名）
+    name = ""
+    use_local = not USE_OCR_PROCESS_POOL
+    if not use_local:
         try:
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
-                f.write(img_bytes)
-                temp_path = f.name
-            
-            results, _ = LOCAL_OCR(temp_path)
-            name = sanitize(pick_top_name(results), "")
-            if name:
-                return name
+            name = _detect_name_in_pool(img_bytes)
+        except BrokenProcessPool as e:
+            # 进程池已重置，下一张图片会重新创建
+            print(f"本地 OCR 进程失败: {e}")
         except Exception as e:
-            print(f"本地 OCR 失败: {e}")
-        finally:
-            if temp_path and os.path.exists(temp_path):
-                try:
-                    os.unlink(temp_path)
-                except:
-                    pass
+            _disable_proc_pool(e)
+            use_local = True
+    if use_local and LOCAL_OCR is not None:
+        name = _detect_name_local(img_bytes)
+    if name:
+        return name
     
     # Fallback: 使用 Gemini
     if gemini_client:
@@ -151,15 +356,9 @@ def detect_name_from_image(img_bytes: bytes, gemini_client=None) -> str:
     return "对方"
 
 
-def ocr_images_with_gemini(
-    images: list[tuple[str, bytes]],  # [(filename, bytes), ...]
-    client,
-    screenshot_date: str
-) -> str:
-    """
-    使用 Gemini API OCR 多张图片，返回格式化的聊天记录
-    """
-    prompt = f"""请 OCR 这些聊天截图并按以下格式输出聊天记录：
+def build_ocr_prompt(screenshot_date: str) -> str:
+    """生成聊天记录 OCR 的 prompt"""
+    return f"""请 OCR 这些聊天截图并按以下格式输出聊天记录：
 
 格式要求：
 1. 每条消息格式: "我: 消息内容" 或 "对方: 消息内容"
@@ -196,29 +395,156 @@ def ocr_images_with_gemini(
 
 请现在开始 OCR 这些图片："""
 
-    # 构建内容：prompt + 所有图片
-    contents = [prompt]
-    for filename, img_bytes in images:
+
+def ocr_images_with_gemini(
+    images: list[tuple[str, BinaryIO]],  # [(filename, file), ...]
+    client,
+    screenshot_date: str
+) -> str:
+    """
+    使用 Gemini API OCR 多张图片，返回格式化的聊天记录
+    """
+    # 构建内容：prompt + 所有图片（常见格式直接发送原始 bytes，无法解码的图片跳过）
+    contents = [build_ocr_prompt(screenshot_date)]
+    for filename, img_file in images:
+        prepared = gemini_image(filename, read_image(img_file))
+        if prepared is not None:
+            data, mime_type = prepared
+            contents.append(types.Part.from_bytes(data=data, mime_type=mime_type))
+
+    if GEMINI_SERVICE_TIER == "flex":
         try:
-            img = Image.open(BytesIO(img_bytes))
-            contents.append(img)
-        except Exception as e:
-            print(f"警告: 无法加载图片 {filename}: {e}")
+            response = client.models.generate_content(
+                model=OCR_MODEL,
+                contents=contents,
+                config=types.GenerateContentConfig(service_tier="flex")
+            )
+            return response.text
+        except errors.APIError as e:
+            # Flex 请求在资源紧张时会被拒绝，改用标准层级重试
+            if e.code != 429 and e.code < 500:
+                raise
+            print(f"Flex 请求被拒绝，改用标准层级: {e}")
+        except ValueError as e:
+            # 旧版 SDK 不支持 service_tier
+            print(f"Flex 层级不可用，改用标准层级: {e}")
 
     response = client.models.generate_content(
-        model="gemini-3-flash-preview",
+        model=OCR_MODEL,
         contents=contents
     )
 
     return response.text
 
 
+def _response_text(response: dict) -> str:
+    """从 Batch 结果中的原始 GenerateContentResponse JSON 提取文本"""
+    candidates = response.get("candidates") or []
+    if not candidates:
+        return ""
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts)
+
+
+def _delete_gemini_file(client, name: str) -> None:
+    """删除 Files API 中的文件，失败只记录日志"""
+    try:
+        client.files.delete(name=name)
+    except Exception as e:
+        print(f"删除 Gemini 文件失败 {name}: {e}")
+
+
+def ocr_groups_with_gemini_batch(
+    group_list: list[tuple[str, list[tuple[str, BinaryIO]]]],  # [(person_name, [(filename, file), ...]), ...]
+    client,
+    screenshot_date: str,
+    timeout: float = GEMINI_BATCH_TIMEOUT,
+    heartbeat: Optional[Callable[[str], None]] = None
+) -> dict[str, str]:
+    """
+    使用 Gemini Batch API 一次性提交所有对话，返回 {person_name: 聊天记录}
+
+    超过 timeout 秒仍未完成时取消任务并抛出 TimeoutError；
+    个别请求失败时对应的 key 不会出现在结果中。
+    """
+    prompt = build_ocr_prompt(screenshot_date)
+
+    # 构建 JSONL 请求文件
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as f:
+        jsonl_path = f.name
+        for person_name, imgs in group_list:
+            parts = [{"text": prompt}]
+            for filename, img_file in imgs:
+                prepared = gemini_image(filename, read_image(img_file))
+                if prepared is None:
+                    continue
+                data, mime_type = prepared
+                parts.append({"inline_data": {
+                    "mime_type": mime_type,
+                    "data": base64.b64encode(data).decode("ascii"),
+                }})
+            line = {"key": person_name, "request": {"contents": [{"role": "user", "parts": parts}]}}
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+    try:
+        uploaded = client.files.upload(
+            file=jsonl_path,
+            config=types.UploadFileConfig(mime_type="jsonl")
+        )
+    finally:
+        os.unlink(jsonl_path)
+
+    # 截图以 base64 存放在 Files API 中，任务结束（含失败/取消）后立即删除
+    try:
+        batch_job = client.batches.create(model=OCR_MODEL, src=uploaded.name)
+
+        # 指数退避轮询
+        deadline = time.monotonic() + timeout
+        delay = 2.0
+        while True:
+            batch_job = client.batches.get(name=batch_job.name)
+            state = batch_job.state.name
+            if state == "JOB_STATE_SUCCEEDED":
+                break
+            if state in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+                raise Exception(f"Batch 任务失败: {state}")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                try:
+                    client.batches.cancel(name=batch_job.name)
+                except Exception as e:
+                    print(f"取消 Batch 任务失败: {e}")
+                raise TimeoutError(f"Batch 任务超过 {timeout:.0f} 秒未完成")
+            if heartbeat:
+                heartbeat(state)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 1.5, 30.0)
+    finally:
+        _delete_gemini_file(client, uploaded.name)
+
+    # 下载并解析结果，结果文件同样包含聊天内容，下载后删除
+    try:
+        result_bytes = client.files.download(file=batch_job.dest.file_name)
+    finally:
+        _delete_gemini_file(client, batch_job.dest.file_name)
+    results = {}
+    for raw_line in result_bytes.decode("utf-8").splitlines():
+        if not raw_line.strip():
+            continue
+        line = json.loads(raw_line)
+        if "response" not in line:
+            print(f"Batch 请求失败 {line.get('key')}: {line.get('error')}")
+            continue
+        results[line["key"]] = _response_text(line["response"])
+    return results
+
+
 # =============================================================================
 # 主处理流程
 # =============================================================================
 
 def process_ocr_workflow(
-    images: list[tuple[str, bytes]],  # [(original_filename, bytes), ...]
+    images: list[tuple[str, BinaryIO, BinaryIO]],  # [(original_filename, original_file, ocr_file), ...]
     city: str,
     house_type: str,
     community: str,
@@ -226,12 +552,13 @@ def process_ocr_workflow(
     screenshot_date: str,
     api_key: str,
     progress_callback: Optional[Callable[[str, int, int], None]] = None
-) -> bytes:
+) -> str:
     """
-    处理 OCR 工作流，返回 ZIP 文件的 bytes
+    处理 OCR 工作流，返回 ZIP 临时文件的路径（由调用方负责删除）
     
     Args:
-        images: 图片列表 [(filename, bytes), ...]
+        images: 图片列表 [(filename, 原图, OCR 用的缩小副本), ...]，文件对象按需读取；
+            ZIP 中保存原图，姓名识别和 Gemini 分析使用副本
         city: 城市
         house_type: 房源类型
         community: 小区
@@ -241,7 +568,7 @@ def process_ocr_workflow(
         progress_callback: 进度回调 (message, current, total)
     
     Returns:
-        ZIP 文件的 bytes
+        ZIP 临时文件路径
     """
     def report(msg: str, current: int = 0, total: int = 0):
         if progress_callback:
@@ -259,25 +586,49 @@ def process_ocr_workflow(
     # 初始化 Gemini 客户端（用于 OCR 和可能的姓名识别 fallback）
     report("正在连接 Gemini...", 0, total_images)
     try:
-        client = genai.Client(api_key=api_key)
+        client = _get_client(api_key)
     except Exception as e:
         report(f"❌ Gemini 连接失败: {e}", 0, 0)
         raise Exception(f"Gemini API 连接失败: {e}")
     
     # 步骤1: 检测每张图片的对方姓名并重命名
-    ocr_method = "本地识别" if LOCAL_OCR else "Gemini识别"
+    ocr_method = "本地识别" if LOCAL_OCR or USE_OCR_PROCESS_POOL else "Gemini识别"
     report(f"正在识别对方姓名（{ocr_method}）...", 0, total_images)
     
-    renamed_images = []  # [(new_filename, bytes, person_name), ...]
+    renamed_images = []  # [(new_filename, original_file, ocr_file, person_name), ...]
     per_name_counter = {}
     
-    for i, (orig_name, img_bytes) in enumerate(images):
-        try:
-            person_name = detect_name_from_image(img_bytes, gemini_client=client)
-        except Exception as e:
-            report(f"⚠️ 姓名识别异常: {e}", i + 1, total_images)
-            person_name = "对方"
-        
+    # 内容完全相同的截图只识别一次（blake2b 足够快，无需加密强度）
+    duplicates = defaultdict(list)  # {内容哈希: [图片下标, ...]}
+    for i, (_, img_file, _) in enumerate(images):
+        digest = hashlib.blake2b(read_image(img_file), digest_size=16).digest()
+        duplicates[digest].append(i)
+    
+    # 并发识别姓名（ONNX 推理 / Gemini 请求都会释放 GIL），结果按原顺序存放
+    person_names = [None] * total_images
+    done_count = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(duplicates)))) as executor:
+        futures = {
+            executor.submit(
+                lambda f: detect_name_from_image(read_image(f), client),
+                images[indices[0]][2]
+            ): indices
+            for indices in duplicates.values()
+        }
+        for future in as_completed(futures):
+            indices = futures[future]
+            done_count += len(indices)
+            try:
+                person_name = future.result()
+            except Exception as e:
+                report(f"⚠️ 姓名识别异常: {e}", done_count, total_images)
+                person_name = "对方"
+            for i in indices:
+                person_names[i] = person_name
+                report(f"已识别 {images[i][0]} → {person_name}", done_count, total_images)
+    
+    # 按上传顺序编号，保证文件名稳定
+    for (orig_name, img_file, ocr_file), person_name in zip(images, person_names):
         order = per_name_counter.get(person_name, 0) + 1
         per_name_counter[person_name] = order
         
@@ -285,17 +636,17 @@ def process_ocr_workflow(
         ext = Path(orig_name).suffix.lower() or ".png"
         new_name = f"{city}-{house_type}-{community}-{recipient}-{person_name}-{order}{ext}"
         
-        report(f"→ {new_name}", i + 1, total_images)
+        report(f"→ {new_name}", total_images, total_images)
         
-        renamed_images.append((new_name, img_bytes, person_name))
+        renamed_images.append((new_name, img_file, ocr_file, person_name))
         
     
     # 步骤2: 按对方姓名分组
     report("正在分组图片...", 0, 0)
     
     groups = defaultdict(list)
-    for new_name, img_bytes, person_name in renamed_images:
-        groups[person_name].append((new_name, img_bytes))
+    for new_name, _, ocr_file, person_name in renamed_images:
+        groups[person_name].append((new_name, ocr_file))
     
     report(f"共 {len(groups)} 个对话", 0, len(groups))
     
@@ -305,26 +656,63 @@ def process_ocr_workflow(
     txt_files = {}  # {filename: content}
     group_list = list(groups.items())
     
-    for i, (person_name, imgs) in enumerate(group_list):
-        report(f"正在分析: {person_name}（{len(imgs)} 张图片）", i + 1, len(groups))
-        
-        chat_content = ocr_images_with_gemini(imgs, client, screenshot_date)
+    batch_results = {}
+    if USE_GEMINI_BATCH:
+        report(f"已提交 Batch 任务（{len(groups)} 个对话）...", 0, len(groups))
+        try:
+            batch_results = ocr_groups_with_gemini_batch(
+                group_list, client, screenshot_date,
+                heartbeat=lambda state: report(f"Batch 任务处理中（{state}）...", 0, len(groups))
+            )
+        except Exception as e:
+            report(f"⚠️ Batch 模式不可用，改为逐个分析: {e}", 0, len(groups))
+    
+    chat_contents = dict(batch_results)
+    pending = [(name, imgs) for name, imgs in group_list if name not in chat_contents]
+    done_count = len(chat_contents)
+    if pending:
+        executor = ThreadPoolExecutor(max_workers=min(GEMINI_PARALLEL, len(pending)))
+        try:
+            futures = {}
+            for person_name, imgs in pending:
+                report(f"正在分析: {person_name}（{len(imgs)} 张图片）", done_count, len(groups))
+                futures[executor.submit(ocr_images_with_gemini, imgs, client, screenshot_date)] = person_name
+            for future in as_completed(futures):
+                person_name = futures[future]
+                chat_contents[person_name] = future.result()
+                done_count += 1
+                report(f"已完成: {person_name}", done_count, len(groups))
+        except Exception:
+            # 任一对话失败时取消排队中的请求，不等待进行中的调用，尽快把错误返回给用户
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+    
+    for person_name, _ in group_list:
         txt_name = f"{city}-{house_type}-{community}-{recipient}-{person_name}.txt"
-        txt_files[txt_name] = chat_content
+        txt_files[txt_name] = chat_contents[person_name]
     
     # 步骤4: 打包 ZIP
     report("正在打包下载文件...", 0, 0)
     
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-        # 添加图片
-        for new_name, img_bytes, _ in renamed_images:
-            zf.writestr(new_name, img_bytes)
-        
-        # 添加 TXT
-        for txt_name, content in txt_files.items():
-            zf.writestr(txt_name, content.encode('utf-8'))
+    with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as zip_file:
+        zip_path = zip_file.name
+    try:
+        # 图片本身已压缩，直接存储；只对 TXT 使用 DEFLATE
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zf:
+            # 添加图片
+            for new_name, img_file, _, _ in renamed_images:
+                img_file.seek(0)
+                with zf.open(new_name, 'w') as dst:
+                    shutil.copyfileobj(img_file, dst)
+            
+            # 添加 TXT
+            for txt_name, content in txt_files.items():
+                zf.writestr(txt_name, content.encode('utf-8'), compress_type=zipfile.ZIP_DEFLATED)
+    except Exception:
+        os.unlink(zip_path)
+        raise
     
     report("完成！", len(groups), len(groups))
     
-    return zip_buffer.getvalue()
+    return zip_path